@@ -7,11 +7,22 @@ Adds: Appeal Type (Murojaat turi / Тип обращения) before appeal text
 
 import os
 import re
+import io
 import csv
-import tempfile
+import time
+import json
+import pickle
+import sqlite3
+import asyncio
+import operator
 import logging
+import httpx
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields as dataclass_fields
 from datetime import datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
+from urllib.parse import urlsplit
+from weakref import WeakValueDictionary
 
 # ---------- logging ----------
 logging.basicConfig(
@@ -27,45 +38,125 @@ try:
 except Exception:
     pass
 
-# ---------- If JSON content provided (Railway-friendly), write it to temp file ----------
-json_env = os.getenv("GOOGLE_SHEETS_JSON_CONTENT")
-if json_env and not os.getenv("GOOGLE_SHEETS_JSON"):
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".json")
-    tmp.write(json_env.encode("utf-8"))
-    tmp.flush()
-    os.environ["GOOGLE_SHEETS_JSON"] = tmp.name
-    log.info("Wrote GOOGLE_SHEETS_JSON to temp file: %s", tmp.name)
-
-# ---------- Google Sheets helper (safe, will not crash bot) ----------
-def try_gs_save_row(sheet_name: str, row: Dict[str, Any]) -> str:
-    """Append to Google Sheet if creds exist. Returns '' on success, error text on failure."""
+# ---------- Optional orjson (faster JSON for the Sheets API bodies), stdlib fallback ----------
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps  # -> bytes
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# ---------- Service-account key: file path, or the JSON itself (Railway-friendly) ----------
+def load_service_account_info() -> Optional[Dict[str, Any]]:
+    """GOOGLE_SHEETS_JSON (path) wins over GOOGLE_SHEETS_JSON_CONTENT (raw JSON, kept in
+    memory only, never written to disk). None if Sheets is not configured."""
+    path = os.environ.get("GOOGLE_SHEETS_JSON")
+    if path:
+        name = "GOOGLE_SHEETS_JSON"
+        with open(path, "rb") as f:
+            raw = f.read()
+    else:
+        name, raw = "GOOGLE_SHEETS_JSON_CONTENT", os.environ.get("GOOGLE_SHEETS_JSON_CONTENT")
+        if not raw:
+            return None
     try:
-        gs_path = os.environ.get("GOOGLE_SHEETS_JSON")
-        if not gs_path:
-            return "GOOGLE_SHEETS_JSON not set"
-        import gspread
+        return _json_loads(raw)
+    except ValueError as e:  # json and orjson decode errors both subclass ValueError
+        # name the variable but never echo the (secret) content
+        raise ValueError(f"{name} is not valid JSON: {e.__class__.__name__}") from None
+
+# ---------- Google Sheets client (async REST, safe, will not crash bot) ----------
+class SheetsClient:
+    """Appends rows to the first sheet of a spreadsheet via the Sheets v4 REST API.
+
+    Fully async: one pooled httpx client (TLS connection kept alive between batches), the
+    service-account access token cached until it expires, and the spreadsheet id looked up
+    by name once (or taken from GOOGLE_SHEETS_ID).
+    """
+
+    SCOPES = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive",
+    ]
+
+    def __init__(self, info: Dict[str, Any], sheet_name: str, spreadsheet_id: str | None = None):
         from google.oauth2.service_account import Credentials
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive",
-        ]
-        creds = Credentials.from_service_account_file(gs_path, scopes=scopes)
-        gc = gspread.authorize(creds)
-        sh = gc.open(os.environ.get("GOOGLE_SHEETS_NAME", sheet_name))
-        ws = sh.sheet1
-        ws.append_row([
-            row["timestamp"], row["lang"], row["user_id"], row["full_name"], row["dob"],
-            row["region"], row["district"], row["mode"], row["phone"],
-            row["appeal_type"],  # NEW
-            row["content"],
-        ])
-        return ""
-    except Exception as e:
-        return str(e)
+        self._creds = Credentials.from_service_account_info(info, scopes=self.SCOPES)
+        self._name = sheet_name
+        self._spreadsheet_id = spreadsheet_id
+        self._http = httpx.AsyncClient(
+            timeout=30.0,
+            limits=httpx.Limits(max_connections=10, keepalive_expiry=600),
+        )
+
+    async def _auth_headers(self, force_refresh: bool = False) -> Dict[str, str]:
+        if force_refresh or not self._creds.valid:
+            from google.auth.transport.requests import Request
+            # token exchange is a one-off blocking call (~once an hour)
+            await asyncio.to_thread(self._creds.refresh, Request())
+        return {"Authorization": f"Bearer {self._creds.token}"}
+
+    async def _request(self, method: str, url: str, body: Any = None, **kwargs) -> httpx.Response:
+        extra = {}
+        if body is not None:
+            kwargs["content"] = _json_dumps(body)
+            extra["Content-Type"] = "application/json"
+        resp = await self._http.request(
+            method, url, headers={**await self._auth_headers(), **extra}, **kwargs
+        )
+        if resp.status_code == 401:
+            # token revoked/expired early: refresh once and retry
+            resp = await self._http.request(
+                method, url, headers={**await self._auth_headers(force_refresh=True), **extra}, **kwargs
+            )
+        resp.raise_for_status()
+        return resp
+
+    async def _get_spreadsheet_id(self) -> str:
+        if self._spreadsheet_id is None:
+            name = self._name.replace("\\", "\\\\").replace("'", "\\'")
+            resp = await self._request(
+                "GET",
+                "https://www.googleapis.com/drive/v3/files",
+                params={
+                    "q": f"name = '{name}' and mimeType = 'application/vnd.google-apps.spreadsheet' "
+                         "and trashed = false",
+                    "fields": "files(id)",
+                    "pageSize": 1,
+                    # also find spreadsheets in shared drives, like gspread's open() did
+                    "supportsAllDrives": "true",
+                    "includeItemsFromAllDrives": "true",
+                },
+            )
+            files = _json_loads(resp.content).get("files", [])
+            if not files:
+                raise LookupError(f"Spreadsheet not found or not shared: {self._name}")
+            self._spreadsheet_id = files[0]["id"]
+        return self._spreadsheet_id
+
+    async def append_rows(self, values: List[List[Any]]) -> None:
+        sid = await self._get_spreadsheet_id()
+        # explicit column span (A:K for 11 columns) and INSERT_ROWS: the rows land right
+        # after the table, without overwriting or Sheets guessing the table bounds
+        span = f"A:{chr(ord('A') + len(values[0]) - 1)}"
+        await self._request(
+            "POST",
+            f"https://sheets.googleapis.com/v4/spreadsheets/{sid}/values/{span}:append",
+            params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+            body={"majorDimension": "ROWS", "values": values},
+        )
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+_sheets: SheetsClient | None = None  # created in post_init when a service-account key is set
 
-def parse_admin_ids(raw: str | None) -> List[int]:
+def parse_admin_ids(raw: str | None) -> frozenset[int]:
     if not raw:
-        return []
+        return frozenset()
     out: List[int] = []
     for p in raw.split(","):
         p = p.strip()
@@ -75,11 +166,12 @@ def parse_admin_ids(raw: str | None) -> List[int]:
             out.append(int(p))
         except ValueError:
             pass
-    return out
+    return frozenset(out)
 
-ADMIN_IDS: List[int] = parse_admin_ids(os.getenv("ADMIN_IDS"))
+ADMIN_IDS: frozenset[int] = parse_admin_ids(os.getenv("ADMIN_IDS"))
 
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -88,8 +180,11 @@ from telegram import (
     ReplyKeyboardRemove,
 )
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     ApplicationBuilder,
+    BasePersistence,
+    PersistenceInput,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
@@ -97,6 +192,114 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
+from telegram.request import HTTPXRequest
+
+# ---------- Optional Redis persistence (keeps user_data + conversation state across restarts) ----------
+class RedisPersistence(BasePersistence):
+    """Stores user_data (pickled) and ConversationHandler states in Redis.
+
+    Only user_data and conversations are persisted; chat/bot/callback data are not used by this bot.
+    """
+
+    def __init__(self, url: str, prefix: str = "sayyor", update_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        from redis import asyncio as aioredis
+        self._redis = aioredis.from_url(url)
+        self._prefix = prefix
+
+    def _user_key(self, user_id: int) -> str:
+        return f"{self._prefix}:user:{user_id}"
+
+    def _conv_key(self, name: str) -> str:
+        return f"{self._prefix}:conv:{name}"
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        out: Dict[int, Dict[Any, Any]] = {}
+        async for key in self._redis.scan_iter(match=self._user_key("*")):
+            raw = await self._redis.get(key)
+            if raw is not None:
+                out[int(key.rsplit(b":", 1)[1])] = pickle.loads(raw)
+        return out
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        await self._redis.set(self._user_key(user_id), pickle.dumps(data))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._redis.delete(self._user_key(user_id))
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> Dict[tuple, object]:
+        raw = await self._redis.hgetall(self._conv_key(name))
+        return {tuple(json.loads(k)): json.loads(v) for k, v in raw.items()}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        field = json.dumps(list(key))
+        if new_state is None:
+            await self._redis.hdel(self._conv_key(name), field)
+        else:
+            await self._redis.hset(self._conv_key(name), field, json.dumps(new_state))
+
+    async def flush(self) -> None:
+        await self._redis.aclose()
+
+    # --- not persisted (see store_data) ---
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+# ---------- Keyboards that serialize once ----------
+class _SerializedOnce:
+    """Mixin for the static keyboards below.
+
+    PTB 20 objects are immutable, yet every send walks all buttons again in to_dict()
+    (~70us for the 14-region keyboard vs ~13us for the json.dumps that follows).
+    Compute the dict once at construction and hand out the same one; do not mutate it.
+    """
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        with self._unfrozen():
+            self._cached_dict = super().to_dict()
+
+    def to_dict(self, recursive: bool = True) -> Dict[str, Any]:
+        if recursive:
+            return self._cached_dict
+        return super().to_dict(recursive=recursive)
+
+class CachedInlineKeyboardMarkup(_SerializedOnce, InlineKeyboardMarkup):
+    __slots__ = ("_cached_dict",)
+
+class CachedReplyKeyboardMarkup(_SerializedOnce, ReplyKeyboardMarkup):
+    __slots__ = ("_cached_dict",)
 
 # ===== States =====
 LANG, REGION, MODE, NAME, DOB, DISTRICT, CONTACT, ATYPE, CONTENT, CONFIRM = range(10)
@@ -118,6 +321,8 @@ REGIONS_RU = [
     "Ферганская область", "Хорезмская область",
 ]
 
+REGION_NAMES = {"uz": REGIONS, "ru": REGIONS_RU}
+
 # ===== Appeal Types (Uz/Ru) =====
 APPEAL_TYPES = {
     "uz": [
@@ -161,6 +366,9 @@ LANG_BTNS = [
     [InlineKeyboardButton("O'zbekcha 🇺🇿", callback_data="lang_uz")],
     [InlineKeyboardButton("Русский 🇷🇺", callback_data="lang_ru")],
 ]
+LANG_FROM_CB = {"lang_uz": "uz", "lang_ru": "ru"}
+WELCOME_FULL = f"{WELCOME_PREVIEW_UZ}\n\n{WELCOME_PREVIEW_RU}\n\n{CHOOSE_LANG}"
+WELCOME_KB = CachedInlineKeyboardMarkup(LANG_BTNS)
 PROMPTS = {
     "uz": {
         "region": "Iltimos, yashash hududingizni tanlang:",
@@ -202,17 +410,68 @@ PROMPTS = {
     },
 }
 
+# CSV export copy; CSV_PATH= (empty) turns it off and leaves SQLite as the only store
 CSV_PATH = os.environ.get("CSV_PATH", "registrations.csv")
+# CSV_DAILY=1: one file per UTC day (registrations-YYYY-MM-DD.csv) instead of a single CSV_PATH
+CSV_DAILY = os.environ.get("CSV_DAILY", "").lower() in ("1", "true", "yes")
+_TS_FMT = "%Y-%m-%d %H:%M:%S"  # UTC, "timestamp" column
+
+@dataclass(slots=True)
+class Registration:
+    """One confirmed registration; field order is the CSV/SQLite/Sheets column order."""
+    timestamp: str
+    lang: str
+    user_id: int
+    full_name: str | None
+    dob: str | None
+    region: str | None
+    district: str | None
+    mode: str | None
+    phone: str | None
+    appeal_type: str | None
+    content: str | None
+
+FIELDS = [f.name for f in dataclass_fields(Registration)]
+# Registration -> tuple in column order (plain csv.writer / positional SQL)
+_row_values = operator.attrgetter(*FIELDS)
+WRITE_BATCH_SIZE = 50
+# primary store: one transaction per batch, WAL mode so readers never block the writer;
+# SQLITE_PATH= (empty) falls back to CSV only
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "registrations.db")
+WRITE_FLUSH_INTERVAL = 2.0  # seconds
+
+# rows waiting for the background writer started in post_init
+_write_queue: "asyncio.Queue[Registration]" = asyncio.Queue()
+_writer_task: asyncio.Task | None = None
+# rows waiting for Google Sheets; only fed while the flusher runs (Sheets configured)
+GS_BATCH_SIZE = 50
+GS_FLUSH_INTERVAL = 2.0  # seconds
+GS_ATTEMPTS = 6  # per batch: first try + 5 retries, waiting 1, 2, 4, 8, 16 s
+GS_RETRY_DELAY = 1.0
+GS_MAX_DELAY = 60.0  # cap for Retry-After on 429
+GS_SHUTDOWN_TIMEOUT = 10.0  # how long shutdown waits for a batch that is mid-retry
+_gs_queue: "asyncio.Queue[Registration]" = asyncio.Queue()
+_gs_task: asyncio.Task | None = None
+# one worker keeps batches ordered, never interleaves CSV lines and serializes SQLite use
+_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+# strong refs so fire-and-forget tasks are not garbage collected mid-flight
+_background_tasks: set[asyncio.Task] = set()
+# per-chat confirm locks; entries vanish once no handler holds them
+_chat_locks: "WeakValueDictionary[int, asyncio.Lock]" = WeakValueDictionary()
+
+def _lock_for(chat_id: int) -> asyncio.Lock:
+    return _chat_locks.setdefault(chat_id, asyncio.Lock())
 
 # ----- Keyboards -----
 def build_regions_keyboard(lang: str) -> InlineKeyboardMarkup:
-    names = REGIONS if lang == "uz" else REGIONS_RU
-    rows = [[InlineKeyboardButton(name, callback_data=f"reg|{name}")] for name in names]
-    return InlineKeyboardMarkup(rows)
+    names = REGION_NAMES[lang]
+    # index, not the name: keeps callback_data well under Telegram's 64-byte cap
+    rows = [[InlineKeyboardButton(name, callback_data=f"reg|{i}")] for i, name in enumerate(names)]
+    return CachedInlineKeyboardMarkup(rows)
 
 def build_mode_keyboard(lang: str) -> InlineKeyboardMarkup:
     t = PROMPTS[lang]
-    return InlineKeyboardMarkup([
+    return CachedInlineKeyboardMarkup([
         [InlineKeyboardButton(t["mode_off"], callback_data="mode|offline")],
         [InlineKeyboardButton(t["mode_on"], callback_data="mode|online")],
     ])
@@ -222,107 +481,462 @@ def build_types_keyboard(lang: str) -> InlineKeyboardMarkup:
     # arrange in two columns for readability
     rows = []
     for i in range(0, len(items), 2):
-        pair = items[i:i+2]
-        rows.append([InlineKeyboardButton(x, callback_data=f"atype|{x}") for x in pair])
-    return InlineKeyboardMarkup(rows)
+        # index, not the label: long Cyrillic labels can exceed the 64-byte callback_data cap
+        rows.append([
+            InlineKeyboardButton(items[j], callback_data=f"atype|{j}")
+            for j in range(i, min(i + 2, len(items)))
+        ])
+    return CachedInlineKeyboardMarkup(rows)
 
 def build_confirm_keyboard(lang: str) -> InlineKeyboardMarkup:
     t = PROMPTS[lang]
-    return InlineKeyboardMarkup([
+    return CachedInlineKeyboardMarkup([
         [InlineKeyboardButton(t["yes"], callback_data="confirm|yes")],
         [InlineKeyboardButton(t["no"], callback_data="confirm|no")],
     ])
 
+# built once; the markups only depend on lang
+REGIONS_KB = {lang: build_regions_keyboard(lang) for lang in PROMPTS}
+MODE_KB = {lang: build_mode_keyboard(lang) for lang in PROMPTS}
+TYPES_KB = {lang: build_types_keyboard(lang) for lang in PROMPTS}
+CONFIRM_KB = {lang: build_confirm_keyboard(lang) for lang in PROMPTS}
+CONTACT_KB = {
+    lang: CachedReplyKeyboardMarkup(
+        [[KeyboardButton(
+            text=("Telefon raqamimni yuborish" if lang == "uz" else "Отправить мой номер"),
+            request_contact=True,
+        )]],
+        resize_keyboard=True,
+        one_time_keyboard=True,
+    )
+    for lang in PROMPTS
+}
+# callback_data prefixes produced by the keyboards above, one per conversation step
+LANG_CB = re.compile(r"^lang_")
+REGION_CB = re.compile(r"^reg\|")
+MODE_CB = re.compile(r"^mode\|")
+ATYPE_CB = re.compile(r"^atype\|")
+CONFIRM_CB = re.compile(r"^confirm\|")
+
 # ----- Utils -----
+_DOB_RE = re.compile(r"\s*(\d{1,2})[./-](\d{1,2})[./-](\d{4})\s*")
+_PHONE_RE = re.compile(r"[+]?[\d][\d\s-]{6,}")
+_PHONE_NORM = re.compile(r"\D", re.ASCII)
+
 def parse_dob(text: str) -> str:
-    m = re.fullmatch(r"\s*(\d{1,2})[./-](\d{1,2})[./-](\d{4})\s*", text or "")
+    m = _DOB_RE.fullmatch(text or "")
     if not m:
         return ""
     d, mth, y = map(int, m.groups())
     try:
-        dt = datetime(y, mth, d)
-        return dt.strftime("%d.%m.%Y")
+        datetime(y, mth, d)  # calendar check only
     except ValueError:
         return ""
+    return f"{d:02d}.{mth:02d}.{y:04d}"
 
-def save_row(row: Dict[str, Any]):
-    file_exists = os.path.isfile(CSV_PATH)
-    with open(CSV_PATH, "a", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(
-            f,
-            fieldnames=[
-                "timestamp","lang","user_id","full_name","dob",
-                "region","district","mode","phone",
-                "appeal_type",            # NEW column
-                "content",
-            ],
-        )
-        if not file_exists:
-            writer.writeheader()
-        writer.writerow(row)
-
-def format_summary(lang: str, ud: Dict[str, Any]) -> str:
-    return (
-        f"\n— Til/Язык: {'O‘zbekcha' if lang=='uz' else 'Русский'}"
-        f"\n— Hudud/Регион: {ud.get('region')}"
-        f"\n— Shakl/Формат: {('Offline' if ud.get('mode')=='offline' else 'Online')}"
-        f"\n— F.I.Sh/Ф.И.О.: {ud.get('full_name')}"
-        f"\n— Tug'ilgan sana/Дата рождения: {ud.get('dob')}"
-        f"\n— Tuman/Rayon: {ud.get('district')}"
-        f"\n— Telefon/Телефон: {ud.get('phone')}"
-        f"\n— Murojaat turi/Тип обращения: {ud.get('appeal_type')}"
-        f"\n— Murojaat/Обращение: {ud.get('content')}\n"
+def _pick(options: List[str], data: str) -> Optional[str]:
+    """Option for "<prefix>|<index>" callback_data; None for a stale keyboard (e.g. sent
+    before a deploy, when buttons carried names) or an out-of-range index."""
+    raw = data.split("|", 1)[1]
+    if raw.isascii() and raw.isdigit() and int(raw) < len(options):
+        return options[int(raw)]
+    return None
+
+def normalize_phone(raw: str, from_contact: bool = False) -> Optional[str]:
+    """'+998 90 123-45-67' -> '+998901234567' (E.164 shape); None unless 9-15 digits.
+
+    A shared contact is always international (Telegram may omit the '+'), so any
+    punctuation is just stripped. Typed text must be international too: a leading '+'
+    or the 998 country code; national forms like '90 123 45 67' or '8 90 ...' are
+    rejected rather than guessed into some other country's number.
+    """
+    raw = (raw or "").strip()
+    digits = _PHONE_NORM.sub("", raw)
+    if not from_contact and not (
+        _PHONE_RE.fullmatch(raw) and (raw.startswith("+") or digits.startswith("998"))
+    ):
+        return None
+    return f"+{digits}" if 9 <= len(digits) <= 15 else None
+
+async def enqueue_row(row: Registration):
+    """Hand a registration to the background writer (SQLite + CSV) and, if running, the Sheets flusher."""
+    await _write_queue.put(row)
+    if _gs_task is not None:
+        _gs_queue.put_nowait(row)
+
+def _open_db(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS registrations ("
+        + ", ".join(f"{k} {'INTEGER' if k == 'user_id' else 'TEXT'}" for k in FIELDS)
+        + ")"
     )
+    conn.execute("CREATE INDEX IF NOT EXISTS registrations_user_id ON registrations (user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS registrations_timestamp ON registrations (timestamp)")
+    return conn
+
+_DB_INSERT = (
+    f"INSERT INTO registrations ({', '.join(FIELDS)}) "
+    f"VALUES ({', '.join('?' * len(FIELDS))})"
+)
+
+def _csv_path_for(day: str) -> str:
+    """CSV file for a UTC date ("YYYY-MM-DD"): CSV_PATH, or its daily shard with CSV_DAILY."""
+    if not CSV_DAILY:
+        return CSV_PATH
+    root, ext = os.path.splitext(CSV_PATH)
+    return f"{root}-{day}{ext}"
+
+def _csv_bytes(values: List[tuple]) -> bytes:
+    out = io.StringIO(newline="")
+    csv.writer(out).writerows(values)
+    return out.getvalue().encode("utf-8")
 
-async def notify_admins(context: ContextTypes.DEFAULT_TYPE, text: str):
-    for admin_id in ADMIN_IDS:
+def _csv_append(data: bytes):
+    """Append one rendered batch to _csv_file, all or nothing: the handle is unbuffered, so
+    nothing lingers in Python to be written again later, and a failed or short write is cut
+    back off the file (then the file is reopened on the next call) so a retry never
+    duplicates rows."""
+    global _csv_path, _csv_file
+    fd = _csv_file.fileno()
+    size = os.fstat(fd).st_size
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[_csv_file.write(view):]
+    except BaseException:
+        try:
+            os.ftruncate(fd, size)
+        except OSError:
+            log.exception("Could not cut a failed write back off %s", _csv_path)
+        _csv_file.close()
+        _csv_file, _csv_path = None, ""
+        raise
+
+def _use_csv(path: str):
+    """Point _csv_file at `path` (header written iff the file is empty), closing the
+    previous file on a day rollover. Only called from _init_storage() and on
+    _write_executor, whose single worker serializes rollovers with writes."""
+    global _csv_path, _csv_file
+    if path == _csv_path:
+        return
+    # open (and write the header) before touching the current handle: if this fails
+    # (EMFILE, ENOSPC, ...) the old file stays usable and the next batch simply retries.
+    # Unbuffered binary: each batch is rendered up front and goes out in one write().
+    f = open(path, "ab", buffering=0)
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            f.write(_csv_bytes([FIELDS]))
+    except BaseException:
+        f.close()
+        raise
+    old, _csv_path, _csv_file = _csv_file, path, f
+    if old is not None:
+        old.close()
+
+def _write_db(rows: List[Registration]):
+    # one transaction per batch, not one per row; rolled back on failure so the connection
+    # (autocommit mode, isolation_level=None) is not left inside an open transaction
+    values = [_row_values(row) for row in rows]
+    _db.execute("BEGIN")
+    try:
+        _db.executemany(_DB_INSERT, values)
+        _db.execute("COMMIT")
+    except BaseException:
+        if _db.in_transaction:
+            _db.execute("ROLLBACK")
+        raise
+    rows.clear()
+
+def _write_csv(rows: List[Registration]):
+    # with CSV_DAILY a batch may straddle midnight: one append per day, each dropped from
+    # `rows` as soon as it is on disk so a failure on the next day never re-sends it
+    while rows:
+        day = rows[0].timestamp[:10]
+        n = len(rows) if not CSV_DAILY else next(
+            (i for i, row in enumerate(rows) if row.timestamp[:10] != day), len(rows)
+        )
+        _use_csv(_csv_path_for(day))
+        _csv_append(_csv_bytes([_row_values(row) for row in rows[:n]]))
+        del rows[:n]
+
+# rows a store has not taken yet; each store retries only its own backlog, so a batch that
+# reached SQLite but not the CSV (or the other way round) is never written twice.
+# Only touched on _write_executor.
+_db_pending: List[Registration] = []
+_csv_pending: List[Registration] = []
+
+def _write_batch(rows: List[Registration]):
+    """Write rows (plus any earlier failures) to SQLite, then the CSV. Never raises: a store
+    that fails keeps the rows it has not stored for the next call."""
+    for name, pending, enabled, write in (
+        ("SQLite", _db_pending, _db is not None, _write_db),
+        ("CSV", _csv_pending, bool(CSV_PATH), _write_csv),
+    ):
+        if not enabled:
+            continue
+        pending.extend(rows)
+        if not pending:
+            continue
+        try:
+            write(pending)
+        except Exception:
+            log.exception("%s write of %d row(s) failed, retrying with the next batch", name, len(pending))
+
+def _gs_retriable(e: Exception) -> bool:
+    """values:append is not idempotent, so only retry when Google clearly did not process
+    the request: quota (429), unavailable (503), or the request never went out. A read
+    timeout or other 5xx may come after the rows were written; retrying those would
+    duplicate them in the sheet (they are still in local storage either way)."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in (429, 503)
+    return isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+def _retry_after(e: Exception) -> Optional[float]:
+    """Seconds from a 429's Retry-After header (delta-seconds form only)."""
+    if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 429:
+        value = e.response.headers.get("Retry-After", "")
+        if value.isdigit():
+            return float(value)
+    return None
+
+async def _gs_sync(rows: List[Registration], attempts: int = GS_ATTEMPTS) -> str:
+    """Append a batch to Google Sheets in one request, retrying transient failures with
+    exponential backoff. Returns '' on success, error text on failure."""
+    if _sheets is None:
+        return ""
+    values = [list(_row_values(row)) for row in rows]
+    delay = GS_RETRY_DELAY
+    for attempt in range(1, attempts + 1):
         try:
-            await context.bot.send_message(chat_id=admin_id, text=text)
+            await _sheets.append_rows(values)
+            return ""
         except Exception as e:
-            log.warning("Admin DM failed for %s: %s", admin_id, e)
+            if attempt == attempts or not _gs_retriable(e):
+                log.exception("Sheets append of %d row(s) failed", len(rows))
+                return str(e)
+            # quota exhausted: Sheets says how long to back off; otherwise double each time
+            wait = min(_retry_after(e) or delay, GS_MAX_DELAY)
+            log.warning("Sheets append failed (%s), retry %d/%d in %.0fs", e, attempt, attempts - 1, wait)
+        await asyncio.sleep(wait)
+        delay *= 2
+    return ""
+
+# opened once by _init_storage() in post_init, owned by _writer_loop afterwards
+_csv_path = ""
+_csv_file = None  # unbuffered binary handle, see _csv_append()
+_db: Optional[sqlite3.Connection] = None
+
+def _init_storage():
+    """Open SQLITE_PATH and the CSV (today's shard with CSV_DAILY) once, before any update
+    is handled: a bad path fails startup instead of silently killing the writer task."""
+    global _db
+    if not (SQLITE_PATH or CSV_PATH):
+        raise RuntimeError("Both SQLITE_PATH and CSV_PATH are empty: nowhere to store registrations")
+    _db = _open_db(SQLITE_PATH) if SQLITE_PATH else None
+    if CSV_PATH:
+        _use_csv(_csv_path_for(time.strftime("%Y-%m-%d", time.gmtime())))
+
+async def _writer_loop(app: Application):
+    """Single long-lived writer: flushes every WRITE_BATCH_SIZE rows or WRITE_FLUSH_INTERVAL
+    seconds, whichever comes first, to the handles opened by _init_storage().
+    The disk write itself runs on _write_executor so the event loop never waits on it
+    (SQLITE_PATH gets one transaction per batch, then the CSV copy is appended; a failed
+    write is retried with the next batch)."""
+    loop = asyncio.get_running_loop()
+    buf: List[Registration] = []
+    try:
+        while True:
+            buf.append(await _write_queue.get())
+            deadline = loop.time() + WRITE_FLUSH_INTERVAL
+            while len(buf) < WRITE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    buf.append(await asyncio.wait_for(_write_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch = buf[:]
+            buf.clear()
+            # disk full, database locked, ...: _write_batch keeps failed rows and retries
+            # them with the next batch instead of losing them (or this task) for good
+            await loop.run_in_executor(_write_executor, _write_batch, batch)
+    finally:
+        # shutdown: persist whatever is still buffered or queued
+        while not _write_queue.empty():
+            buf.append(_write_queue.get_nowait())
+        # same executor, so this also waits out any in-flight batch
+        # before the file is closed
+        await loop.run_in_executor(_write_executor, _write_batch, buf)
+        if buf:
+            log.info("Flushed %d pending row(s) on shutdown", len(buf))
+        for name, pending in (("SQLite", _db_pending), ("CSV", _csv_pending)):
+            if pending:
+                log.error("Lost %d row(s) not written to %s on shutdown", len(pending), name)
+        if _csv_file is not None:
+            _csv_file.close()
+        if _db is not None:
+            _db.close()
+
+async def _gs_flusher(app: Application):
+    """Google Sheets sync, separate from the local writer so a slow or rate-limited Sheets API
+    never delays local persistence. Like _writer_loop, collects up to GS_BATCH_SIZE rows or
+    GS_FLUSH_INTERVAL seconds' worth, whichever comes first, and sends them in one append
+    call (a burst of registrations costs one request, keeping well inside the Sheets quota).
+    Transient failures are retried with backoff inside _gs_sync; admins hear only about
+    batches that still fail."""
+    loop = asyncio.get_running_loop()
+    in_flight: asyncio.Future | None = None
+    batch: List[Registration] = []
+    try:
+        while True:
+            batch = [await _gs_queue.get()]
+            deadline = loop.time() + GS_FLUSH_INTERVAL
+            while len(batch) < GS_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(_gs_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            in_flight = asyncio.ensure_future(_gs_sync(batch))
+            gs_err = await asyncio.shield(in_flight)
+            in_flight = None
+            sent, batch = batch, []
+            if gs_err:
+                await notify_admins(app.bot, f"⚠️ Sheets ({len(sent)} row(s)): {gs_err}")
+    finally:
+        # shutdown: let the current call finish (so it is not re-sent), then push the rest;
+        # a batch stuck in backoff is given up on (it is still in local storage)
+        if in_flight is not None:
+            try:
+                await asyncio.wait_for(in_flight, GS_SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                log.warning("Gave up syncing an in-flight Sheets batch on shutdown")
+        # rows still being collected when cancelled have not been sent yet
+        rest: List[Registration] = batch if in_flight is None else []
+        while not _gs_queue.empty():
+            rest.append(_gs_queue.get_nowait())
+        if rest:
+            log.info("Syncing %d pending row(s) to Sheets on shutdown", len(rest))
+            await _gs_sync(rest, attempts=1)
+
+LANG_NAMES = {"uz": "O‘zbekcha", "ru": "Русский"}
+SUMMARY_TMPL = (
+    "\n— Til/Язык: {lang_name}"
+    "\n— Hudud/Регион: {region}"
+    "\n— Shakl/Формат: {mode_name}"
+    "\n— F.I.Sh/Ф.И.О.: {full_name}"
+    "\n— Tug'ilgan sana/Дата рождения: {dob}"
+    "\n— Tuman/Rayon: {district}"
+    "\n— Telefon/Телефон: {phone}"
+    "\n— Murojaat turi/Тип обращения: {appeal_type}"
+    "\n— Murojaat/Обращение: {content}\n"
+)
+
+# ----- Per-user session -----
+@dataclass(slots=True)
+class Session:
+    """Everything one user has answered so far, stored as user_data["_s"].
+
+    A fixed slotted record instead of up to nine loose user_data keys: no per-user
+    __dict__ and plain attribute access in the handlers. Unanswered fields stay None.
+    """
+    lang: str = "uz"
+    full_name: str | None = None
+    dob: str | None = None
+    region: str | None = None
+    district: str | None = None
+    mode: str | None = None
+    phone: str | None = None
+    appeal_type: str | None = None
+    content: str | None = None
+
+def get_session(context: ContextTypes.DEFAULT_TYPE) -> Session:
+    s = context.user_data.get("_s")
+    if s is None:
+        # only build a Session when missing (setdefault would allocate one every call)
+        s = context.user_data["_s"] = Session()
+    return s
+
+# answers collected by the conversation, in CSV column order
+ANSWER_FIELDS = ("full_name", "dob", "region", "district", "mode", "phone", "appeal_type", "content")
+_ANSWERS_GET = operator.attrgetter(*ANSWER_FIELDS)
+
+def get_answers(s: Session) -> Dict[str, Any]:
+    return dict(zip(ANSWER_FIELDS, _ANSWERS_GET(s)))
+
+def format_summary(s: Session) -> str:
+    fields = get_answers(s)
+    fields["lang_name"] = LANG_NAMES[s.lang]
+    fields["mode_name"] = "Offline" if fields["mode"] == "offline" else "Online"
+    return SUMMARY_TMPL.format_map(fields)
+
+async def notify_admins(bot: Bot, text: str):
+    # all DMs in parallel: latency is the slowest send, not the sum
+    results = await asyncio.gather(
+        *(bot.send_message(chat_id=admin_id, text=text) for admin_id in ADMIN_IDS),
+        return_exceptions=True,
+    )
+    for admin_id, res in zip(ADMIN_IDS, results):
+        if isinstance(res, Exception):
+            log.error("Admin DM failed for %s", admin_id, exc_info=res)
 
 # ===== Handlers =====
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
         return LANG
-    text = f"{WELCOME_PREVIEW_UZ}\n\n{WELCOME_PREVIEW_RU}\n\n{CHOOSE_LANG}"
-    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(LANG_BTNS))
+    await update.message.reply_text(WELCOME_FULL, reply_markup=WELCOME_KB)
     return LANG
 
 async def choose_lang(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    lang = "uz" if q.data == "lang_uz" else "ru"
-    context.user_data["lang"] = lang
-    await q.edit_message_text(PROMPTS[lang]["region"], reply_markup=build_regions_keyboard(lang))
+    lang = LANG_FROM_CB.get(q.data)
+    if lang is None:
+        await q.edit_message_text(WELCOME_FULL, reply_markup=WELCOME_KB)
+        return LANG
+    get_session(context).lang = lang
+    await q.edit_message_text(PROMPTS[lang]["region"], reply_markup=REGIONS_KB[lang])
     return REGION
 
 async def choose_region(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    _, name = q.data.split("|", 1)
-    context.user_data["region"] = name
-    lang = context.user_data["lang"]
-    await q.edit_message_text(PROMPTS[lang]["mode"], reply_markup=build_mode_keyboard(lang))
+    s = get_session(context)
+    lang = s.lang
+    region = _pick(REGION_NAMES[lang], q.data)
+    if region is None:
+        # stale or bogus button: show a fresh keyboard
+        await q.edit_message_text(PROMPTS[lang]["region"], reply_markup=REGIONS_KB[lang])
+        return REGION
+    s.region = region
+    await q.edit_message_text(PROMPTS[lang]["mode"], reply_markup=MODE_KB[lang])
     return MODE
 
 async def choose_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    _, mode = q.data.split("|", 1)
-    context.user_data["mode"] = mode
-    lang = context.user_data["lang"]
+    s = get_session(context)
+    _, s.mode = q.data.split("|", 1)
+    lang = s.lang
     await q.edit_message_text(PROMPTS[lang]["name"])
     return NAME
 
 async def full_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["full_name"] = (update.message.text or "").strip()
-    lang = context.user_data["lang"]
+    s = get_session(context)
+    s.full_name = (update.message.text or "").strip()
+    lang = s.lang
     await update.message.reply_text(PROMPTS[lang]["dob"])
     return DOB
 
 async def dob(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    lang = context.user_data.get("lang", "uz")
+    s = get_session(context)
+    lang = s.lang
     parsed = parse_dob(update.message.text)
     if not parsed:
         await update.message.reply_text(
@@ -330,94 +944,97 @@ async def dob(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Неверный формат даты. Используйте дд.мм.гггг."
         )
         return DOB
-    context.user_data["dob"] = parsed
+    s.dob = parsed
     await update.message.reply_text(PROMPTS[lang]["district"])
     return DISTRICT
 
 async def district(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["district"] = (update.message.text or "").strip()
-    lang = context.user_data.get("lang", "uz")
-    btn = KeyboardButton(
-        text=("Telefon raqamimni yuborish" if lang == "uz" else "Отправить мой номер"),
-        request_contact=True,
-    )
-    kb = ReplyKeyboardMarkup([[btn]], resize_keyboard=True, one_time_keyboard=True)
-    await update.message.reply_text(PROMPTS[lang]["contact"], reply_markup=kb)
+    s = get_session(context)
+    s.district = (update.message.text or "").strip()
+    lang = s.lang
+    await update.message.reply_text(PROMPTS[lang]["contact"], reply_markup=CONTACT_KB[lang])
     return CONTACT
 
 async def contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    lang = context.user_data.get("lang", "uz")
-    phone = None
-    if update.message.contact and update.message.contact.phone_number:
-        phone = update.message.contact.phone_number
+    s = get_session(context)
+    lang = s.lang
+    c = update.message.contact
+    if c and c.phone_number:
+        phone = normalize_phone(c.phone_number, from_contact=True)
     else:
-        txt = (update.message.text or "").strip()
-        if re.fullmatch(r"[+]?[\d][\d\s-]{6,}", txt):
-            phone = txt
+        phone = normalize_phone(update.message.text)
     if not phone:
         await update.message.reply_text(
             "Iltimos, tugma orqali yuboring yoki +998… formatida yozing." if lang == "uz" else
             "Пожалуйста, отправьте через кнопку или в формате +998…"
         )
         return CONTACT
-    context.user_data["phone"] = phone
+    s.phone = phone
     # NEW: ask for appeal type now
-    await update.message.reply_text(PROMPTS[lang]["atype"], reply_markup=build_types_keyboard(lang))
+    await update.message.reply_text(PROMPTS[lang]["atype"], reply_markup=TYPES_KB[lang])
     return ATYPE
 
 async def choose_atype(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    _, atype = q.data.split("|", 1)
-    context.user_data["appeal_type"] = atype
-    lang = context.user_data.get("lang", "uz")
+    s = get_session(context)
+    lang = s.lang
+    appeal_type = _pick(APPEAL_TYPES[lang], q.data)
+    if appeal_type is None:
+        await q.edit_message_text(PROMPTS[lang]["atype"], reply_markup=TYPES_KB[lang])
+        return ATYPE
+    s.appeal_type = appeal_type
     await q.edit_message_text(PROMPTS[lang]["content"])
     return CONTENT
 
 async def content(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["content"] = (update.message.text or "").strip()
-    lang = context.user_data.get("lang", "uz")
-    summary = format_summary(lang, context.user_data)
+    s = get_session(context)
+    s.content = (update.message.text or "").strip()
+    lang = s.lang
+    summary = format_summary(s)
     await update.message.reply_text(PROMPTS[lang]["confirm"] + "\n" + summary,
-                                    reply_markup=build_confirm_keyboard(lang))
+                                    reply_markup=CONFIRM_KB[lang])
     return CONFIRM
 
 async def confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    lang = context.user_data.get("lang", "uz")
+    s = get_session(context)
+    lang = s.lang
     _, val = q.data.split("|", 1)
     if val == "no":
-        await q.edit_message_text(PROMPTS[lang]["region"], reply_markup=build_regions_keyboard(lang))
+        await q.edit_message_text(PROMPTS[lang]["region"], reply_markup=REGIONS_KB[lang])
         return REGION
 
-    ud = context.user_data
-    row = {
-        "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-        "lang": lang,
-        "user_id": q.from_user.id,
-        "full_name": ud.get("full_name"),
-        "dob": ud.get("dob"),
-        "region": ud.get("region"),
-        "district": ud.get("district"),
-        "mode": ud.get("mode"),
-        "phone": ud.get("phone"),
-        "appeal_type": ud.get("appeal_type"),  # NEW
-        "content": ud.get("content"),
-    }
-
-    save_row(row)
-    gs_err = try_gs_save_row(os.environ.get("GOOGLE_SHEETS_NAME", "SayyorQabul"), row)
+    # serialize confirms per chat (a double-tap delivers two "yes" callbacks for the
+    # same summary message) without holding up other chats
+    async with _lock_for(update.effective_chat.id):
+        if context.chat_data.get("confirmed_msg_id") == q.message.message_id:
+            return ConversationHandler.END
+        row = Registration(time.strftime(_TS_FMT, time.gmtime()), lang, q.from_user.id, *_ANSWERS_GET(s))
 
-    note = "✅ Yangi ro‘yxatdan o‘tish:" if lang == "uz" else "✅ Новая регистрация:"
-    extra = f"\n⚠️ Sheets: {gs_err}" if gs_err else ""
-    await notify_admins(context, note + format_summary(lang, ud) + extra)
+        await enqueue_row(row)
+        context.chat_data["confirmed_msg_id"] = q.message.message_id
+        summary = format_summary(s)
 
-    await q.edit_message_text(PROMPTS[lang]["thanks"])
+        # ack first; admin DMs happen after the user already sees "thanks"
+        await q.edit_message_text(PROMPTS[lang]["thanks"])
+    task = asyncio.create_task(_notify_registration(context, lang, summary))
+    _background_tasks.add(task)
+    task.add_done_callback(_on_task_done)
     return ConversationHandler.END
 
+async def _notify_registration(context: ContextTypes.DEFAULT_TYPE, lang: str, summary: str):
+    note = "✅ Yangi ro‘yxatdan o‘tish:" if lang == "uz" else "✅ Новая регистрация:"
+    await notify_admins(context.bot, note + summary)
+
+def _on_task_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("Background task failed: %s", task.exception())
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    lang = context.user_data.get("lang", "uz")
+    lang = get_session(context).lang
     await update.message.reply_text("Bekor qilindi." if lang == "uz" else "Отменено.",
                                     reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
@@ -430,48 +1047,154 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     log.error("Exception while handling update: %s", context.error)
 
 # ===== Main =====
-async def post_init(app: Application):
-    import telegram, sys
-    log.info("PTB VERSION: %s | PYTHON: %s", getattr(telegram, "__version__", "unknown"), sys.version)
-    await app.bot.set_my_commands([
+# None = default list for clients whose language has no dedicated entry
+BOT_COMMANDS = {
+    None: [
         ("start", "Boshlash / Старт"),
         ("cancel", "Bekor qilish / Отмена"),
         ("whoami", "User ID ni ko‘rish"),
-    ])
+    ],
+    "uz": [
+        ("start", "Boshlash"),
+        ("cancel", "Bekor qilish"),
+        ("whoami", "User ID ni ko‘rish"),
+    ],
+    "ru": [
+        ("start", "Старт"),
+        ("cancel", "Отмена"),
+        ("whoami", "Узнать свой user ID"),
+    ],
+}
+
+async def post_init(app: Application):
+    global _writer_task, _gs_task, _sheets
+    import telegram, sys
+    log.info("PTB VERSION: %s | PYTHON: %s", getattr(telegram, "__version__", "unknown"), sys.version)
+    for language_code, commands in BOT_COMMANDS.items():
+        current = await app.bot.get_my_commands(language_code=language_code)
+        if [(c.command, c.description) for c in current] != commands:
+            await app.bot.set_my_commands(commands, language_code=language_code)
+    _init_storage()
+    _writer_task = asyncio.create_task(_writer_loop(app))
+    # Sheets is optional: a bad or unreadable key disables it instead of stopping the bot
+    try:
+        sa_info = load_service_account_info()
+        if sa_info:
+            _sheets = SheetsClient(
+                sa_info,
+                os.environ.get("GOOGLE_SHEETS_NAME", "SayyorQabul"),
+                os.environ.get("GOOGLE_SHEETS_ID"),
+            )
+    except Exception as e:
+        log.exception("Google Sheets disabled: could not load the service-account key")
+        await notify_admins(app.bot, f"⚠️ Sheets disabled: {e}")
+    if _sheets is not None:
+        _gs_task = asyncio.create_task(_gs_flusher(app))
+
+async def post_shutdown(app: Application):
+    for task in (_writer_task, _gs_task):
+        if task is None:
+            continue
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # a crashed task must not keep the others from being stopped
+            log.exception("Background task %s failed", task.get_name())
+    if _sheets is not None:
+        await _sheets.aclose()
 
 def main():
     token = os.environ.get("TELEGRAM_TOKEN")
     if not token:
         raise RuntimeError("Set TELEGRAM_TOKEN env var")
 
-    app: Application = ApplicationBuilder().token(token).post_init(post_init).build()
+    # optional faster event loop (libuv); PTB picks it up via the policy
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        log.info("Using uvloop event loop")
+    except ImportError:
+        pass
+
+    # HTTP/2 multiplexes concurrent calls over a few kept-alive TLS connections (needs h2)
+    try:
+        import h2  # noqa: F401
+        http_version = "2"
+    except ImportError:
+        http_version = "1.1"
+    # outbound Bot API calls (replies, edits, admin DMs); getUpdates keeps PTB's own
+    # single-connection request since only one long-poll is ever in flight
+    bot_request = HTTPXRequest(
+        connection_pool_size=256,
+        connect_timeout=5.0,
+        read_timeout=10.0,
+        write_timeout=10.0,
+        pool_timeout=1.0,
+        http_version=http_version,
+    )
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .request(bot_request)
+        # smooths outbound traffic under Telegram's ~30 msg/s bot-wide limit and retries 429s
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1, max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    redis_url = os.environ.get("REDIS_URL")
+    if redis_url:
+        builder = builder.persistence(RedisPersistence(redis_url))
+        log.info("Using Redis persistence")
+    app: Application = builder.build()
 
+    # one shared filter instance for every free-text state
+    text_no_cmd = filters.TEXT & ~filters.COMMAND
     conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
-            LANG: [CallbackQueryHandler(choose_lang, pattern=r"^lang_")],
-            REGION: [CallbackQueryHandler(choose_region, pattern=r"^reg\|")],
-            MODE: [CallbackQueryHandler(choose_mode, pattern=r"^mode\|")],
-            NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, full_name)],
-            DOB: [MessageHandler(filters.TEXT & ~filters.COMMAND, dob)],
-            DISTRICT: [MessageHandler(filters.TEXT & ~filters.COMMAND, district)],
+            LANG: [CallbackQueryHandler(choose_lang, pattern=LANG_CB)],
+            REGION: [CallbackQueryHandler(choose_region, pattern=REGION_CB)],
+            MODE: [CallbackQueryHandler(choose_mode, pattern=MODE_CB)],
+            NAME: [MessageHandler(text_no_cmd, full_name)],
+            DOB: [MessageHandler(text_no_cmd, dob)],
+            DISTRICT: [MessageHandler(text_no_cmd, district)],
             CONTACT: [
                 MessageHandler(filters.CONTACT, contact),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, contact),
+                MessageHandler(text_no_cmd, contact),
             ],
-            ATYPE: [CallbackQueryHandler(choose_atype, pattern=r"^atype\|")],  # NEW
-            CONTENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, content)],
-            CONFIRM: [CallbackQueryHandler(confirm, pattern=r"^confirm\|")],
+            ATYPE: [CallbackQueryHandler(choose_atype, pattern=ATYPE_CB)],  # NEW
+            CONTENT: [MessageHandler(text_no_cmd, content)],
+            CONFIRM: [CallbackQueryHandler(confirm, pattern=CONFIRM_CB)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         allow_reentry=True,
+        name="registration",
+        persistent=bool(redis_url),
     )
 
     app.add_handler(conv)
     app.add_handler(CommandHandler("whoami", whoami))
     app.add_error_handler(error_handler)
 
-    app.run_polling(close_loop=False)
+    # webhook mode: Telegram pushes updates, no long-poll round-trip per update.
+    # WEBHOOK_URL is the full public URL; PUBLIC_HOST is shorthand for https://<host>/<token>
+    webhook_url = os.environ.get("WEBHOOK_URL")
+    if not webhook_url and os.environ.get("PUBLIC_HOST"):
+        webhook_url = f"https://{os.environ['PUBLIC_HOST']}/{token}"
+    if webhook_url:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.environ.get("PORT", 8443)),
+            url_path=urlsplit(webhook_url).path.lstrip("/"),
+            webhook_url=webhook_url,
+            secret_token=os.environ.get("WEBHOOK_SECRET"),
+            close_loop=False,
+        )
+    else:
+        app.run_polling(close_loop=False)
 
 if __name__ == "__main__":
     main()